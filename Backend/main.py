@@ -1,19 +1,30 @@
 # main.py
 """
-FastAPI backend that uses Qdrant server-side BM25 + Gemini dense vectors.
-- Qdrant will compute BM25 sparse vectors (if collection was ingested with models.Document(..., model='Qdrant/bm25'))
+FastAPI backend that uses Qdrant BM25 + Gemini dense vectors.
+- The collection holds fastembed 'Qdrant/bm25' SparseVectors uploaded by qdrant_loader.py; Qdrant applies IDF at query time
+- The BM25 query vector is computed locally with fastembed, the dense one with Gemini
 - The endpoint '/query' asks Qdrant to run a hybrid query via Query API (prefetch + FusionQuery)
-Fallback: if server-side hybrid throws (no inference support), we fall back to dense-only search.
+- '/query/stream' does the same retrieval but streams the answer as server-sent events
+Fallback: if the hybrid query throws, that request falls back to dense-only search.
 """
 
 import os
+import json
 import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, models
+from fastembed import SparseTextEmbedding
 import google.generativeai as genai
 from tenacity import retry, wait_exponential, stop_after_attempt
+from async_lru import alru_cache
+from aiolimiter import AsyncLimiter
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
@@ -21,6 +32,9 @@ load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+# gRPC keeps one persistent HTTP/2 channel open; set to "false" if the cluster only exposes REST
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
 
 if not GOOGLE_API_KEY or not QDRANT_URL or not QDRANT_API_KEY:
     raise SystemExit("Set GOOGLE_API_KEY, QDRANT_URL and QDRANT_API_KEY in .env")
@@ -29,38 +43,232 @@ if not GOOGLE_API_KEY or not QDRANT_URL or not QDRANT_API_KEY:
 COLLECTION_NAME = "hospital-rag-data-hybrid"  # must match ingestion
 DENSE_VECTOR_NAME = "dense"
 SPARSE_VECTOR_NAME = "bm25"
+SPARSE_MODEL_NAME = "Qdrant/bm25"  # must match the model the loader indexed with
 VECTOR_SIZE = 3072
 EMBEDDING_MODEL = "models/gemini-embedding-001"
 LLM_MODEL = "gemini-1.5-flash"
+# search the int8-quantized dense vectors, then rescore the oversampled candidates in float32
+DENSE_SEARCH_PARAMS = models.SearchParams(
+    quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+# in-process LRU sizes for repeated (lowercased) questions
+EMBED_CACHE_SIZE = 2048
+ANSWER_CACHE_SIZE = 512
+# worker threads for asyncio.to_thread (Gemini calls are blocking SDK calls)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "64"))
+# Gemini calls in flight at once, and the per-minute request budget
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "600"))
+# precomputed {question: embedding} for frequent questions (see warm_embeddings.py)
+WARM_EMBEDDINGS_FILE = os.getenv("WARM_EMBEDDINGS_FILE", "warm_embeddings.json")
 
 # Init clients
 genai.configure(api_key=GOOGLE_API_KEY)
-qdrant = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+qdrant = AsyncQdrantClient(
+    url=QDRANT_URL,
+    api_key=QDRANT_API_KEY,
+    prefer_grpc=QDRANT_PREFER_GRPC,
+    grpc_port=QDRANT_GRPC_PORT,
+    timeout=10
+)
 llm = genai.GenerativeModel(LLM_MODEL)
+# loaded once at import, so no request pays for loading the model on the event loop
+bm25_model = SparseTextEmbedding(model_name=SPARSE_MODEL_NAME)
+# shared by every request: the semaphore caps concurrent calls and the token bucket
+# spreads them over the minute, so tenacity only has to deal with the rare real 429
+GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+GEMINI_LIMITER = AsyncLimiter(GEMINI_RPM, 60)
 
-app = FastAPI(title="RAG API (Qdrant BM25 + Gemini)")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the default executor (min(32, cpus + 4) threads) is too small once several
+    # users each fan out embedding + generation calls
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="rag-io"))
+    if os.path.exists(WARM_EMBEDDINGS_FILE):
+        with open(WARM_EMBEDDINGS_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        for question, vector in data.items():
+            warm_embeddings[question.strip().lower()] = np.asarray(vector, dtype=np.float32)
+        print(f"Loaded {len(warm_embeddings)} warm query embeddings.")
+    # the module-level Qdrant client (and its connection) lives for the whole process
+    yield
+    await qdrant.close()
+
+
+app = FastAPI(title="RAG API (Qdrant BM25 + Gemini)", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 
+_PROMPT_TMPL = (
+    "You are a helpful assistant. Use the following context to answer the question. "
+    "If the answer is not in the context, say 'I don't have enough information to answer that.'\n\n"
+    "Context:\n{context}\n\nQuestion: {q}\n\nAnswer:"
+)
+
+# filled at startup from WARM_EMBEDDINGS_FILE; checked before the LRU / Gemini
+warm_embeddings = {}
+
+
 class QueryRequest(BaseModel):
     query: str
 
 
+@alru_cache(maxsize=EMBED_CACHE_SIZE)
 @retry(wait=wait_exponential(multiplier=1, min=2, max=8), stop=stop_after_attempt(4))
 async def get_dense_embedding(text: str):
-    resp = await asyncio.to_thread(genai.embed_content, model=EMBEDDING_MODEL, content=text, task_type="RETRIEVAL_DOCUMENT")
-    return resp["embedding"]
+    async with GEMINI_SEM, GEMINI_LIMITER:
+        resp = await asyncio.to_thread(genai.embed_content, model=EMBEDDING_MODEL, content=text, task_type="RETRIEVAL_DOCUMENT")
+    # float32 array: ~12 KB per cached vector instead of ~100 KB of boxed Python floats
+    return np.asarray(resp["embedding"], dtype=np.float32)
+
+
+async def get_query_embedding(text: str):
+    # two-tier lookup: precomputed FAQ embeddings, then the LRU-cached Gemini call
+    vector = warm_embeddings.get(text)
+    if vector is not None:
+        return vector
+    return await get_dense_embedding(text)
+
+
+@alru_cache(maxsize=ANSWER_CACHE_SIZE)
+async def generate_answer(prompt: str):
+    # the prompt holds both the question and the retrieved context, so a cache hit
+    # means same question + same sources; failures raise and are not cached
+    async with GEMINI_SEM, GEMINI_LIMITER:
+        resp = await asyncio.to_thread(llm.generate_content, prompt, stream=False)
+    return resp.text if hasattr(resp, "text") else ""
+
+
+async def get_sparse_embedding(text: str):
+    # BM25 query weights (plain term ids; Qdrant applies IDF from the collection's modifier)
+    sv = await asyncio.to_thread(lambda: next(iter(bm25_model.query_embed(text))))
+    return models.SparseVector(indices=sv.indices.tolist(), values=sv.values.tolist())
 
 
 async def get_llm_answer(prompt: str):
     try:
-        resp = await asyncio.to_thread(llm.generate_content, prompt, stream=False)
-        return resp.text if hasattr(resp, "text") else ""
+        return await generate_answer(prompt)
     except Exception as e:
         print("LLM generation failed:", e)
         return "I don't have enough information to answer that."
 
 
+async def retrieve_context(q: str):
+    """
+    Run hybrid retrieval for an already normalized query.
+    Returns (context, sources) for building the LLM prompt.
+    """
+    # 1) compute dense embedding (Gemini) and BM25 query vector (fastembed, worker thread) together
+    dense_vector, query_sparse = await asyncio.gather(get_query_embedding(q), get_sparse_embedding(q))
+    # gRPC packs this as float32 on the wire; the client wants a plain list to build the request
+    query_dense = dense_vector.tolist()
+
+    # 2) Build prefetch list:
+    #    - dense prefetch: use the dense vector and tell Qdrant to search the 'dense' named vector
+    #    - sparse prefetch: search the 'bm25' named sparse vector with the local BM25 query vector
+    prefetchs = [
+        models.Prefetch(
+            query=query_dense,
+            using=DENSE_VECTOR_NAME,
+            params=DENSE_SEARCH_PARAMS,
+            limit=50
+        ),
+        models.Prefetch(
+            query=query_sparse,
+            using=SPARSE_VECTOR_NAME,
+            limit=50
+        ),
+    ]
+
+    # 3) Ask Qdrant to fuse results server-side using RRF fusion
+    fusion_query = models.FusionQuery(fusion=models.Fusion.RRF)
+
+    points = None
+    try:
+        # query_points will run the prefetches and fuse results on the server.
+        result = await qdrant.query_points(
+            collection_name=COLLECTION_NAME,
+            prefetch=prefetchs,
+            query=fusion_query,
+            with_payload=True,
+            limit=6
+        )
+        points = result.points if hasattr(result, "points") else result
+        print("Using server-side hybrid Qdrant search.")
+    except Exception as e:
+        # only this request falls back to dense-only search; the next one tries hybrid again
+        print("Hybrid Qdrant query failed:", repr(e))
+
+    if points is None:
+        print("Falling back to dense-only Qdrant search.")
+        # query_points with `using` replaces the removed search(query_vector=(name, vector)) API
+        result = await qdrant.query_points(
+            collection_name=COLLECTION_NAME,
+            query=query_dense,
+            using=DENSE_VECTOR_NAME,
+            search_params=DENSE_SEARCH_PARAMS,
+            limit=6,
+            with_payload=True
+        )
+        points = result.points
+
+    # 4) Build context for LLM
+    sources = [{"id": p.id, "text": (p.payload or {}).get("text") or "N/A"} for p in points]
+    context = "\n\n".join("Content: " + src["text"] for src in sources)
+    return context, sources
+
+
+def build_prompt(context: str, q: str):
+    return _PROMPT_TMPL.format_map({"context": context, "q": q})
+
+
+def sse_event(data, event: str = None):
+    # JSON-encode the data so newlines in model output can't break SSE framing
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def stream_llm_answer(prompt: str):
+    """
+    Yield answer text chunks as Gemini produces them. The blocking stream is
+    consumed in a worker thread and handed back to the event loop via a queue.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def consume():
+        try:
+            for chunk in llm.generate_content(prompt, stream=True):
+                text = getattr(chunk, "text", "")
+                if text:
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    async def produce():
+        # the permit covers the Gemini stream only; chunks are buffered in the queue,
+        # so a slow HTTP client never holds a slot other requests are waiting for
+        async with GEMINI_SEM, GEMINI_LIMITER:
+            await asyncio.to_thread(consume)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        await producer
+
+
 @app.post("/query")
 async def query_endpoint(req: QueryRequest):
     q = req.query.strip()
@@ -68,79 +276,15 @@ async def query_endpoint(req: QueryRequest):
         raise HTTPException(status_code=400, detail="Empty query")
 
     try:
-        # 1) compute dense embedding locally (Gemini)
         # lowercase the query text
         q = q.lower()
-        query_dense = await get_dense_embedding(q)
-
-        # 2) Build prefetch list:
-        #    - dense prefetch: use the dense vector and tell Qdrant to search the 'dense' named vector
-        #    - sparse prefetch: send a Document to Qdrant and let it compute BM25 sparse query on the server
-        prefetchs = [
-            models.Prefetch(
-                query=query_dense,
-                using=DENSE_VECTOR_NAME,
-                limit=50
-            ),
-            models.Prefetch(
-                query=models.Document(text=q, model="Qdrant/bm25"),
-                using=SPARSE_VECTOR_NAME,
-                limit=50
-            ),
-        ]
-
-        # 3) Ask Qdrant to fuse results server-side using RRF fusion
-        fusion_query = models.FusionQuery(fusion=models.Fusion.RRF)
-
-        try:
-            # query_points will run the prefetches and fuse results on the server.
-            result = qdrant.query_points(
-                collection_name=COLLECTION_NAME,
-                prefetch=prefetchs,
-                query=fusion_query,
-                with_payload=True,
-                limit=6
-            )
-            points = result.points if hasattr(result, "points") else result
-            print("Using server-side hybrid Qdrant search.")
-        except Exception as e:
-            # If server-side hybrid is not supported by this Qdrant cluster, fallback to dense-only search
-            print("Server-side hybrid query failed (maybe cluster has no inference support):", e)
-            print("Falling back to dense-only Qdrant search.")
-            hits = qdrant.search(
-                collection_name=COLLECTION_NAME,
-                query_vector=query_dense,
-                limit=6,
-                with_payload=True,
-                vector_name=DENSE_VECTOR_NAME
-            )
-            points = hits
-
-        # 4) Build context for LLM
-        context_parts = []
-        sources = []
-        for p in points:
-            payload_text = "N/A"
-            try:
-                if p.payload and "text" in p.payload:
-                    payload_text = p.payload.get("text")
-                else:
-                    payload_text = str(p.payload)
-            except Exception:
-                payload_text = "N/A"
-            context_parts.append(f"Content: {payload_text}")
-            sources.append({"id": p.id, "text": payload_text})
-        context = "\n\n".join(context_parts)
+        context, sources = await retrieve_context(q)
 
         if not context.strip():
             return {"query": q, "answer": "I don't have enough information to answer that.", "sources": []}
 
         # 5) Ask LLM (Gemini) to answer using the retrieved context
-        full_prompt = (
-            "You are a helpful assistant. Use the following context to answer the question. "
-            "If the answer is not in the context, say 'I don't have enough information to answer that.'\n\n"
-            f"Context:\n{context}\n\nQuestion: {q}\n\nAnswer:"
-        )
+        full_prompt = build_prompt(context, q)
         answer = await get_llm_answer(full_prompt)
 
         # return {"query": q, "answer": answer, "sources": sources}
@@ -149,3 +293,43 @@ async def query_endpoint(req: QueryRequest):
     except Exception as e:
         print("Error in /query:", e)
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/query/stream")
+async def query_stream_endpoint(req: QueryRequest):
+    """
+    Same as /query, but streams the answer as server-sent events:
+    one `data: {"text": ...}` event per chunk, then a final `sources` event.
+    If generation fails after chunks were sent, an `error` event precedes `sources`.
+    """
+    q = req.query.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Empty query")
+
+    q = q.lower()
+    try:
+        context, sources = await retrieve_context(q)
+    except Exception as e:
+        print("Error in /query/stream:", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def token_generator():
+        if not context.strip():
+            yield sse_event({"text": "I don't have enough information to answer that."})
+            yield sse_event([], event="sources")
+            return
+        streamed = False
+        try:
+            async for text in stream_llm_answer(build_prompt(context, q)):
+                streamed = True
+                yield sse_event({"text": text})
+        except Exception as e:
+            print("LLM generation failed:", e)
+            if streamed:
+                # part of the answer is already on screen; don't append the fallback to it
+                yield sse_event({"detail": "Answer generation was interrupted."}, event="error")
+            else:
+                yield sse_event({"text": "I don't have enough information to answer that."})
+        yield sse_event(sources, event="sources")
+
+    return StreamingResponse(token_generator(), media_type="text/event-stream")
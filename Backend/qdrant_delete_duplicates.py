@@ -1,4 +1,5 @@
 import os
+import hashlib
 from collections import defaultdict
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
@@ -11,6 +12,8 @@ load_dotenv()
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 QDRANT_COLLECTION_NAME = "hospital-rag-data"
+SCROLL_PAGE_SIZE = 2000
+DELETE_BATCH_SIZE = 1000
 
 # Check for required environment variables
 if not all([QDRANT_URL, QDRANT_API_KEY]):
@@ -44,21 +47,32 @@ def delete_duplicate_points(client: QdrantClient, collection_name: str):
         return
 
     # Step 2: Scroll through the collection to get all points
-    # We'll use a dictionary to store points by their text content
+    # We'll use a dictionary to store point IDs by a 16-byte hash of their text content,
+    # keeping a short preview only for texts that turn out to be duplicated
     points_by_text = defaultdict(list)
+    previews = {}
     try:
-        all_points = client.scroll(
-            collection_name=collection_name,
-            limit=100,  # Scroll limit, can be adjusted
-            with_vectors=False,
-            with_payload=True
-        )
-
-        for points, _ in all_points:
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_vectors=False,
+                with_payload=["text"]  # only the field we dedupe on
+            )
+
             for point in points:
-                if "text" in point.payload:
+                if point.payload and "text" in point.payload:
                     text_content = point.payload["text"]
-                    points_by_text[text_content].append(point.id)
+                    key = hashlib.blake2b(text_content.encode("utf-8"), digest_size=16).digest()
+                    point_ids = points_by_text[key]
+                    point_ids.append(point.id)
+                    if len(point_ids) == 2:
+                        previews[key] = text_content[:50]
+
+            if offset is None:
+                break
 
         print(f"Found a total of {len(points_by_text)} unique text entries.")
 
@@ -68,19 +82,20 @@ def delete_duplicate_points(client: QdrantClient, collection_name: str):
 
     # Step 3: Identify and collect IDs of duplicate points
     duplicate_ids_to_delete = []
-    for text_content, point_ids in points_by_text.items():
+    for key, point_ids in points_by_text.items():
         if len(point_ids) > 1:
             # Keep the first point, delete the rest
             duplicate_ids_to_delete.extend(point_ids[1:])
-            print(f"Found {len(point_ids) - 1} duplicates for text: '{text_content[:50]}...'")
+            print(f"Found {len(point_ids) - 1} duplicates for text: '{previews[key]}...'")
 
     if not duplicate_ids_to_delete:
         print("No duplicate points found.")
         return
 
     # Step 4: Delete the identified duplicates in batches
-    # We will use a batch size of 100 to avoid timeouts
-    batch_size = 100
+    # A filter on `text` would also match the copy we keep, so delete by ID;
+    # an ID selector is tiny on the wire, so batches can be large
+    batch_size = DELETE_BATCH_SIZE
     for i in range(0, len(duplicate_ids_to_delete), batch_size):
         batch_ids = duplicate_ids_to_delete[i:i + batch_size]
         try:
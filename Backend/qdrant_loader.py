@@ -3,21 +3,26 @@
 Create a Qdrant collection with dense + BM25 sparse vectors and upload points.
 
 Requirements:
-  pip install qdrant-client google-generativeai tenacity python-dotenv tqdm
+  pip install qdrant-client google-generativeai tenacity python-dotenv tqdm numpy fastembed
 Notes:
-  - This code asks Qdrant to compute BM25 sparse vectors server-side by sending
-    models.Document(text=..., model="Qdrant/bm25"). That requires Qdrant Cloud
-    or a Qdrant server with FastEmbed/Cloud inference enabled.
+  - BM25 sparse vectors are computed locally with fastembed ("Qdrant/bm25") and
+    uploaded as plain SparseVectors, so ingestion doesn't depend on server-side
+    inference. The collection applies the IDF modifier, matching the BM25 query
+    vectors main.py asks Qdrant for.
 """
 
 import os
-import json
-import time
+import random
+import argparse
+import asyncio
+import numpy as np
 from dotenv import load_dotenv
-from tenacity import retry, wait_exponential, stop_after_attempt
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_not_exception_type
+from google.api_core.exceptions import InvalidArgument
 from qdrant_client import QdrantClient, models
 from qdrant_client.models import VectorParams, SparseVectorParams, Distance, Modifier
 import google.generativeai as genai
+from fastembed import SparseTextEmbedding
 from tqdm import tqdm
 
 load_dotenv()
@@ -34,21 +39,82 @@ INPUT_FILE = "hospital_chunks.txt"   # one chunk per line
 COLLECTION_NAME = "hospital-rag-data-hybrid"
 DENSE_VECTOR_NAME = "dense"
 SPARSE_VECTOR_NAME = "bm25"          # name Qdrant will use for BM25 sparse vectors
+SPARSE_MODEL_NAME = "Qdrant/bm25"
 VECTOR_SIZE = 3072                   # Gemini dense dim
 BATCH_SIZE = 64
+UPLOAD_PARALLEL = 4                  # upload worker processes
+DENSE_CACHE_FILE = "embeddings_cache.npy"  # float32 [n_chunks, VECTOR_SIZE]
+INDEXING_THRESHOLD = 20000           # Qdrant default, restored after bulk upload
+EMBED_BATCH_SIZE = 100               # Gemini batch embed limit per request
+EMBED_CONCURRENCY = 4                # batch embed requests in flight at once
+EMBED_JITTER = 0.05                  # max random delay (s) before each request
 
 # Init clients
 genai.configure(api_key=GOOGLE_API_KEY)
 EMBEDDING_MODEL = "models/gemini-embedding-001"
-client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+# gRPC sends vectors as packed protobuf floats instead of JSON; long timeout for bulk batches
+client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=300, prefer_grpc=True)
 
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(5))
-def create_dense_embedding(text: str):
-    resp = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type="RETRIEVAL_DOCUMENT")
+# a rejected input fails the same way every time, so it isn't retried; reraise so callers
+# see the API error itself rather than tenacity's RetryError
+@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(5),
+       retry=retry_if_not_exception_type(InvalidArgument), reraise=True)
+def create_dense_embeddings(texts):
+    # a list of contents is sent as one batchEmbedContents request
+    resp = genai.embed_content(model=EMBEDDING_MODEL, content=texts, task_type="RETRIEVAL_DOCUMENT")
     return resp["embedding"]
 
 
+def embed_batch_bisect(texts):
+    """
+    Embed a batch; if the API rejects it as invalid input, split it in half and
+    embed each half, so one bad text doesn't fail the other 99. Any other error
+    (auth, quota, network) would fail every half too, so it is raised as is.
+    """
+    try:
+        return create_dense_embeddings(texts)
+    except InvalidArgument:
+        if len(texts) == 1:
+            raise
+        mid = len(texts) // 2
+        return embed_batch_bisect(texts[:mid]) + embed_batch_bisect(texts[mid:])
+
+
+async def embed_chunks(chunks):
+    """
+    Embed all chunks with up to EMBED_CONCURRENCY batch requests in flight.
+    Each batch retries on its own; rows of the returned float32 matrix line up with `chunks`.
+    """
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    progress = tqdm(total=len(chunks), desc="dense embed")
+    # filled batch by batch, so only one batch of boxed Python floats is alive at a time
+    dense = np.empty((len(chunks), VECTOR_SIZE), dtype=np.float32)
+
+    async def worker(start):
+        batch = chunks[start:start + EMBED_BATCH_SIZE]
+        # hold the permit through retries so backoff also throttles new requests
+        async with sem:
+            # small jitter so freed permits don't fire requests in lockstep
+            await asyncio.sleep(random.uniform(0, EMBED_JITTER))
+            vectors = await asyncio.to_thread(embed_batch_bisect, batch)
+        dense[start:start + len(batch)] = vectors
+        progress.update(len(batch))
+
+    await asyncio.gather(*(worker(i) for i in range(0, len(chunks), EMBED_BATCH_SIZE)))
+    progress.close()
+    return dense
+
+
+def create_sparse_embeddings(chunks):
+    # BM25 term weights computed on local cores (fastembed / ONNX), one pass over all chunks
+    bm25 = SparseTextEmbedding(model_name=SPARSE_MODEL_NAME)
+    return [
+        models.SparseVector(indices=sv.indices.tolist(), values=sv.values.tolist())
+        for sv in tqdm(bm25.embed(chunks, batch_size=BATCH_SIZE, parallel=os.cpu_count()), total=len(chunks), desc="bm25 embed")
+    ]
+
+
 def read_chunks(path):
     if not os.path.exists(path):
         raise FileNotFoundError(f"{path} not found")
@@ -61,85 +127,102 @@ def ensure_hybrid_collection(recreate=False):
     Create collection with both dense and sparse (BM25) configs.
     If recreate=True, existing collection will be deleted (data loss).
     """
-    try:
-        cols = client.get_collections()
-        names = [c.name for c in cols.collections]
-    except Exception:
-        names = []
-
-    if COLLECTION_NAME in names:
-        print(f"Collection {COLLECTION_NAME} already exists.")
-        return
+    if client.collection_exists(collection_name=COLLECTION_NAME):
+        if not recreate:
+            print(f"Collection {COLLECTION_NAME} already exists.")
+            return
+        print(f"Deleting existing collection {COLLECTION_NAME}...")
+        client.delete_collection(collection_name=COLLECTION_NAME)
 
     # create collection with named dense + sparse BM25
     print(f"Creating collection {COLLECTION_NAME} with '{DENSE_VECTOR_NAME}' + '{SPARSE_VECTOR_NAME}'...")
     client.create_collection(
         collection_name=COLLECTION_NAME,
         vectors_config={
-            DENSE_VECTOR_NAME: VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE)
+            DENSE_VECTOR_NAME: VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE, on_disk=True)
         },
         # set sparse modifier to IDF so BM25/IDF weighting is used
         sparse_vectors_config={
             SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)
         },
+        # int8 copies of the dense vectors kept in RAM for search (4x smaller);
+        # the original float32 vectors stay on disk for rescoring
+        quantization_config=models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=True)
+        ),
+        # don't build HNSW while points stream in; upload_points() re-enables it afterwards
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
     )
     print("Collection created.")
 
 
-def upload_points(chunks, dense_vectors):
+def upload_points(chunks, dense_vectors, sparse_vectors):
     """
-    Upload points where sparse vector is declared as models.Document; Qdrant will
-    compute BM25 sparse vectors server-side (requires Cloud / FastEmbed).
+    Upload points with the Gemini dense vector and the locally computed BM25 sparse vector.
     """
-    assert len(chunks) == len(dense_vectors)
-    total = len(chunks)
-    for start in range(0, total, BATCH_SIZE):
-        end = min(start + BATCH_SIZE, total)
-        batch = []
-        for i in range(start, end):
-            # build vector value with dense list and server-side document for BM25
+    assert len(chunks) == len(dense_vectors) == len(sparse_vectors)
+
+    def point_iter():
+        for i in range(len(chunks)):
             vec = {
-                DENSE_VECTOR_NAME: dense_vectors[i],
-                SPARSE_VECTOR_NAME: models.Document(text=chunks[i], model="Qdrant/bm25")
+                DENSE_VECTOR_NAME: dense_vectors[i].tolist(),
+                SPARSE_VECTOR_NAME: sparse_vectors[i]
             }
-            point = models.PointStruct(
+            yield models.PointStruct(
                 id=i,
                 vector=vec,
                 payload={"text": chunks[i]}
             )
-            batch.append(point)
-        client.upsert(collection_name=COLLECTION_NAME, points=batch)
-        print(f"Uploaded points {start}-{end-1}")
-        time.sleep(0.15)
+
+    # upload_points batches the iterator and spreads batches over worker processes;
+    # failed batches are retried by the client instead of sleeping between every batch
+    client.upload_points(
+        collection_name=COLLECTION_NAME,
+        points=point_iter(),
+        batch_size=BATCH_SIZE,
+        parallel=UPLOAD_PARALLEL,
+        max_retries=3
+    )
+    print(f"Uploaded {len(chunks)} points")
+
+    # build the HNSW index once, now that all points are in
+    client.update_collection(
+        collection_name=COLLECTION_NAME,
+        optimizer_config=models.OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+    )
+    print("Re-enabled indexing.")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Embed hospital chunks and upload them to Qdrant.")
+    parser.add_argument("--recreate", action="store_true", help="drop and recreate the collection (data loss)")
+    args = parser.parse_args()
+
     chunks = read_chunks(INPUT_FILE)
     if not chunks:
         print("No chunks found. Exiting.")
         return
 
-    ensure_hybrid_collection(recreate=True)
+    ensure_hybrid_collection(recreate=args.recreate)
 
-    dense_cache = "embeddings_cache.json"
-    dense_vectors = []
-    if os.path.exists(dense_cache):
-        with open(dense_cache, "r", encoding="utf-8") as f:
-            dense_vectors = json.load(f)
+    dense_vectors = None
+    if os.path.exists(DENSE_CACHE_FILE):
+        # memory-mapped: rows are paged in as they are uploaded, no float parsing
+        dense_vectors = np.load(DENSE_CACHE_FILE, mmap_mode="r")
         if len(dense_vectors) != len(chunks):
             print("Dense cache length mismatch. Regenerating.")
-            dense_vectors = []
+            dense_vectors = None
 
-    if not dense_vectors:
+    if dense_vectors is None:
         print("Generating dense embeddings (Gemini)...")
-        for c in tqdm(chunks, desc="dense embed"):
-            emb = create_dense_embedding(c)
-            dense_vectors.append(emb)
-        with open(dense_cache, "w", encoding="utf-8") as f:
-            json.dump(dense_vectors, f)
-
-    print("Uploading points (dense + ask Qdrant to compute BM25)...")
-    upload_points(chunks, dense_vectors)
+        dense_vectors = asyncio.run(embed_chunks(chunks))
+        np.save(DENSE_CACHE_FILE, dense_vectors)
+
+    print("Generating BM25 sparse vectors (fastembed)...")
+    sparse_vectors = create_sparse_embeddings(chunks)
+
+    print("Uploading points (dense + BM25)...")
+    upload_points(chunks, dense_vectors, sparse_vectors)
     print("Done.")
 
 
@@ -1,13 +1,19 @@
 import os
-import json
+import orjson
 import random
 import asyncio
+import functools
+from collections import defaultdict
 import google.generativeai as genai
 from tqdm import tqdm
+from tenacity import retry, wait_exponential, wait_exponential_jitter, stop_after_attempt, retry_if_exception_type
+from google.api_core.exceptions import ResourceExhausted
 from typing import List, Dict
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import ScoredPoint
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http.models import Distance, VectorParams, SparseVectorParams, SparseVector, OptimizersConfigDiff
+from qdrant_client.http.models import ScalarQuantization, ScalarQuantizationConfig, ScalarType
+from qdrant_client.http.models import SearchParams, QuantizationSearchParams
 from fastembed import SparseTextEmbedding
 import numpy as np
 
@@ -20,7 +26,22 @@ QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 
 COLLECTION_NAME = "hospital-rag-eval"
 VECTOR_SIZE = 3072
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+EMBED_BATCH_SIZE = 100  # Gemini batch embed limit per request
+EMBED_CONCURRENCY = 10  # Gemini embedding / search calls in flight at once
+UPLOAD_BATCH_SIZE = 256
+# one upload worker: extra workers are spawned processes that re-import this script
+# (and its SPLADE model load), which costs far more than a small eval corpus saves
+UPLOAD_PARALLEL = 1
+INDEXING_THRESHOLD = 20000  # Qdrant default, restored after the bulk load
+CANDIDATES = 50         # per-retriever list length fed into hybrid fusion
+SPARSE_BATCH_SIZE = 32  # texts per SPLADE forward pass
+LLM_CONCURRENCY = 16    # query-generation calls in flight at once
+RRF_K = 60
+SPARSE_MODEL_NAME = "prithivida/Splade_PP_en_v1"  # fastembed's SPLADE++ checkpoint
 DATASET_DIR = "beir_dataset"
+# ONNX Runtime threads for SPLADE; this script encodes in bulk, so use every core
+SPARSE_THREADS = os.cpu_count()
 os.makedirs(DATASET_DIR, exist_ok=True)
 
 genai.configure(api_key=GOOGLE_API_KEY)
@@ -28,15 +49,30 @@ llm = genai.GenerativeModel("gemini-1.5-flash")
 
 qdrant = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
 
-# SPLADE model (500MB load)
-sparse_model = SparseTextEmbedding(model_name="splade")
+# SPLADE model (500MB load), created once and shared by ingestion and eval
+sparse_model = SparseTextEmbedding(model_name=SPARSE_MODEL_NAME, threads=SPARSE_THREADS, providers=["CPUExecutionProvider"])
+
+# in-process inverted index over the corpus SPLADE vectors, filled by build_sparse_index()
+sparse_index = {}
+# query text -> SPLADE vector, filled in one batch by encode_queries_sparse()
+query_sparse = {}
+# unit-normalised copy of the corpus dense vectors, filled by upload_corpus()
+dense_index = {}
 
 # -------------------------
 # 1. Synthetic Query Generation
 # -------------------------
-async def generate_queries_for_chunk(doc_id: str, text: str, num_q: int = 3) -> List[Dict]:
+@retry(wait=wait_exponential_jitter(), stop=stop_after_attempt(5), retry=retry_if_exception_type(ResourceExhausted))
+async def generate_with_retry(prompt: str):
+    # only 429s are retried; anything else is a real failure
+    return await asyncio.to_thread(llm.generate_content, prompt)
+
+async def generate_queries_for_chunk(doc_id: str, text: str, sem: asyncio.Semaphore, num_q: int = 3) -> List[Dict]:
     prompt = f"Generate {num_q} realistic user questions that could be answered by this passage:\n\n{text}"
-    response = await asyncio.to_thread(llm.generate_content, prompt)
+    # stagger start-up so the first wave doesn't arrive as one burst
+    await asyncio.sleep(random.uniform(0, 0.2))
+    async with sem:
+        response = await generate_with_retry(prompt)
     if not hasattr(response, "text"):
         return []
     questions = [q.strip("-• \n") for q in response.text.split("\n") if q.strip()]
@@ -45,11 +81,12 @@ async def generate_queries_for_chunk(doc_id: str, text: str, num_q: int = 3) ->
 async def build_dataset(chunks: List[str], num_q: int = 3):
     corpus, queries, qrels = {}, {}, {}
 
+    sem = asyncio.Semaphore(LLM_CONCURRENCY)
     tasks = []
     for i, chunk in enumerate(chunks):
         doc_id = f"doc{i}"
         corpus[doc_id] = {"_id": doc_id, "text": chunk}
-        tasks.append(generate_queries_for_chunk(doc_id, chunk, num_q))
+        tasks.append(generate_queries_for_chunk(doc_id, chunk, sem, num_q))
 
     results = await asyncio.gather(*tasks)
 
@@ -62,18 +99,18 @@ async def build_dataset(chunks: List[str], num_q: int = 3):
             q_idx += 1
 
     # Save BEIR-style dataset
-    with open(os.path.join(DATASET_DIR, "corpus.jsonl"), "w", encoding="utf-8") as f:
-        for doc in corpus.values():
-            f.write(json.dumps(doc) + "\n")
+    with open(os.path.join(DATASET_DIR, "corpus.jsonl"), "wb") as f:
+        f.writelines(orjson.dumps(doc) + b"\n" for doc in corpus.values())
 
-    with open(os.path.join(DATASET_DIR, "queries.jsonl"), "w", encoding="utf-8") as f:
-        for q in queries.values():
-            f.write(json.dumps(q) + "\n")
+    with open(os.path.join(DATASET_DIR, "queries.jsonl"), "wb") as f:
+        f.writelines(orjson.dumps(q) + b"\n" for q in queries.values())
 
     with open(os.path.join(DATASET_DIR, "qrels.txt"), "w", encoding="utf-8") as f:
-        for qid, doc_dict in qrels.items():
-            for doc_id, rel in doc_dict.items():
-                f.write(f"{qid} 0 {doc_id} {rel}\n")
+        f.write("".join(
+            f"{qid} 0 {doc_id} {rel}\n"
+            for qid, doc_dict in qrels.items()
+            for doc_id, rel in doc_dict.items()
+        ))
 
     return corpus, queries, qrels
 
@@ -81,57 +118,206 @@ async def build_dataset(chunks: List[str], num_q: int = 3):
 # 2. Qdrant Setup
 # -------------------------
 def setup_collection():
-    qdrant.recreate_collection(
+    # every run builds a fresh synthetic corpus, so points from an earlier run must not survive
+    if qdrant.collection_exists(collection_name=COLLECTION_NAME):
+        qdrant.delete_collection(collection_name=COLLECTION_NAME)
+    qdrant.create_collection(
         collection_name=COLLECTION_NAME,
         vectors_config={
-            "dense": VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
-            "sparse": VectorParams(size=sparse_model.dimensions, distance=Distance.DOT),
-        }
+            # int8 copy in RAM for search, float32 originals kept for rescoring
+            "dense": VectorParams(
+                size=VECTOR_SIZE,
+                # vectors are unit-normalised client-side, so dot product == cosine
+                distance=Distance.DOT,
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+                ),
+            ),
+        },
+        sparse_vectors_config={
+            "sparse": SparseVectorParams(),
+        },
+        # no HNSW building while the corpus streams in; upload_corpus() re-enables it
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
     )
     print(f"Collection '{COLLECTION_NAME}' created.")
 
-def upload_corpus(corpus: Dict[str, Dict]):
-    from google.generativeai import embed_content
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    # unit length along the last axis, in place; works for one vector or a matrix of rows
+    x /= np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+    return x
+
+@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(5))
+def embed_documents(texts: List[str]) -> List[List[float]]:
+    # one batchEmbedContents request for the whole slice
+    return genai.embed_content(model=EMBEDDING_MODEL, content=texts, task_type="RETRIEVAL_DOCUMENT")["embedding"]
+
+async def upload_corpus(corpus: Dict[str, Dict]):
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    items = list(corpus.items())
+    progress = tqdm(total=len(items), desc="Embedding docs")
+
+    # SoA layout: one contiguous float32 matrix, each batch fills its own row slice
+    dense = np.empty((len(items), VECTOR_SIZE), dtype=np.float32)
+
+    async def embed_batch(start):
+        texts = [doc["text"] for _, doc in items[start:start + EMBED_BATCH_SIZE]]
+        # Dense (bounded: this is the rate-limited remote call)
+        async with sem:
+            vecs = await asyncio.to_thread(embed_documents, texts)
+        dense[start:start + len(vecs)] = vecs
+        progress.update(len(texts))
+
+    # Sparse: the whole corpus in one batched SPLADE pass, running while the dense requests are in flight
+    texts = [doc["text"] for _, doc in items]
+    sparse_task = asyncio.to_thread(embed_sparse_sorted, texts)
+    _, sparse_vecs = await asyncio.gather(
+        asyncio.gather(*(embed_batch(i) for i in range(0, len(items), EMBED_BATCH_SIZE))),
+        sparse_task,
+    )
+    progress.close()
+    doc_ids = [doc_id for doc_id, _ in items]
+    build_sparse_index(doc_ids, sparse_vecs)
+    # normalised once here: the DOT collection and the local matrix share the same rows
+    l2_normalize(dense)
+    dense_index["doc_ids"] = doc_ids
+    dense_index["matrix"] = dense
+
+    # Qdrant point ids must be unsigned ints or UUIDs, so points are numbered by corpus
+    # position and search results map back through dense_index["doc_ids"].
+    # Named dense+sparse points still need per-point dicts, so rows are only converted here.
+    await asyncio.to_thread(
+        qdrant.upload_collection,
+        collection_name=COLLECTION_NAME,
+        vectors=(
+            {"dense": row.tolist(), "sparse": SparseVector(indices=sv.indices.tolist(), values=sv.values.tolist())}
+            for row, sv in zip(dense, sparse_vecs)
+        ),
+        payload=[{"text": doc["text"]} for _, doc in items],
+        ids=range(len(doc_ids)),
+        batch_size=UPLOAD_BATCH_SIZE,
+        parallel=UPLOAD_PARALLEL,
+    )
+    # build the HNSW index once over the loaded corpus
+    qdrant.update_collection(
+        collection_name=COLLECTION_NAME,
+        optimizer_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD),
+    )
+
+def embed_sparse_sorted(texts: List[str]) -> list:
+    # batches are padded to their longest text, so encode longest-first to keep
+    # similar lengths together, then put the vectors back in corpus order
+    order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+    out = [None] * len(texts)
+    for pos, vec in zip(order, sparse_model.embed([texts[i] for i in order], batch_size=SPARSE_BATCH_SIZE)):
+        out[pos] = vec
+    return out
 
-    points = []
-    for doc_id, doc in tqdm(corpus.items(), desc="Uploading docs"):
-        # Dense
-        dense = embed_content(model="models/gemini-embedding-001", content=doc["text"], task_type="RETRIEVAL_DOCUMENT")["embedding"]
-        # Sparse
-        sparse = sparse_model.encode([doc["text"]])[0]
+def build_sparse_index(doc_ids: List[str], sparse_vecs):
+    """
+    Build a CSR-style inverted index: postings for each SPLADE token id are stored
+    contiguously, so scoring a query touches only the postings of its own tokens.
+    """
+    lengths = [len(sv.indices) for sv in sparse_vecs]
+    tokens = np.concatenate([sv.indices for sv in sparse_vecs])
+    order = np.argsort(tokens, kind="stable")
+    tokens = tokens[order]
+    vocab, starts = np.unique(tokens, return_index=True)
+    ends = np.append(starts[1:], len(tokens))
 
-        points.append({
-            "id": doc_id,
-            "vector": {"dense": dense, "sparse": sparse},
-            "payload": {"text": doc["text"]}
-        })
-    qdrant.upsert(collection_name=COLLECTION_NAME, points=points)
+    sparse_index["doc_ids"] = doc_ids
+    sparse_index["docs"] = np.repeat(np.arange(len(doc_ids)), lengths)[order]
+    sparse_index["weights"] = np.concatenate([sv.values for sv in sparse_vecs]).astype(np.float32)[order]
+    sparse_index["postings"] = {int(t): (int(a), int(b)) for t, a, b in zip(vocab, starts, ends)}
 
 # -------------------------
 # 3. Evaluation
 # -------------------------
-def search_dense(query: str, top_k: int = 5) -> List[str]:
-    dense = genai.embed_content(model="models/gemini-embedding-001", content=query, task_type="RETRIEVAL_QUERY")["embedding"]
-    hits = qdrant.search(collection_name=COLLECTION_NAME, query_vector=("dense", dense), limit=top_k, with_payload=False)
-    return [h.id for h in hits]
+def rrf(lists: List[List[str]], top_k: int, k: int = RRF_K) -> List[str]:
+    scores = defaultdict(float)
+    for lst in lists:
+        for rank, doc_id in enumerate(lst):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
 
-def search_hybrid_bm25(query: str, top_k: int = 5) -> List[str]:
-    dense = genai.embed_content(model="models/gemini-embedding-001", content=query, task_type="RETRIEVAL_QUERY")["embedding"]
+# each eval pass (dense-only, hybrid) embeds the same queries; memoize by text
+@functools.lru_cache(maxsize=None)
+@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(5))
+def embed_query(text: str) -> tuple:
+    return tuple(genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type="RETRIEVAL_QUERY")["embedding"])
+
+def search_dense(query: str, top_k: int = 5) -> List[str]:
+    # the production path: int8-quantized HNSW in Qdrant with float32 rescoring; evaluated
+    # next to search_dense_local so quantization / ANN recall loss shows up as a gap
+    dense = l2_normalize(np.asarray(embed_query(query), dtype=np.float32)).tolist()
     hits = qdrant.query_points(
         collection_name=COLLECTION_NAME,
-        prefetch=[
-            {"query": {"dense": dense}, "weight": 0.5},
-            {"query": {"sparse": sparse_model.encode([query])[0]}, "weight": 0.5},
-        ],
-        limit=top_k
+        query=dense,
+        using="dense",
+        search_params=SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)),
+        limit=top_k,
+        with_payload=False
     ).points
-    return [h.id for h in hits]
+    return [dense_index["doc_ids"][h.id] for h in hits]
+
+def search_dense_local(query: str, top_k: int = 5) -> List[str]:
+    # cosine top-k (a plain dot, rows are unit vectors) against the in-process matrix: the eval
+    # corpus is small enough that one matvec beats a Qdrant round-trip (production still uses Qdrant)
+    q = l2_normalize(np.asarray(embed_query(query), dtype=np.float32))
+    scores = dense_index["matrix"] @ q
+    k = min(top_k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [dense_index["doc_ids"][i] for i in top]
+
+def encode_queries_sparse(texts: List[str]):
+    # one batched SPLADE pass over every eval query instead of one forward pass per search
+    for text, qv in zip(texts, sparse_model.query_embed(texts, batch_size=SPARSE_BATCH_SIZE)):
+        query_sparse[text] = qv
+
+def search_sparse(query: str, top_k: int = 5) -> List[str]:
+    # scored against the in-process index: no Qdrant round-trip for the sparse side
+    qv = query_sparse.get(query)
+    if qv is None:
+        qv = next(iter(sparse_model.query_embed(query)))
+    docs, weights, postings = sparse_index["docs"], sparse_index["weights"], sparse_index["postings"]
+    scores = np.zeros(len(sparse_index["doc_ids"]), dtype=np.float32)
+    for token, w in zip(qv.indices.tolist(), qv.values.tolist()):
+        span = postings.get(token)
+        if span is not None:
+            # a token appears at most once per doc, so fancy-index += is safe here
+            scores[docs[span[0]:span[1]]] += w * weights[span[0]:span[1]]
+    k = min(top_k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [sparse_index["doc_ids"][i] for i in top if scores[i] > 0]
 
-def eval_pipeline(queries: Dict[str, Dict], qrels: Dict[str, Dict], search_fn, name: str):
+# both eval passes rank the same queries; compute each retriever's candidates once
+@functools.lru_cache(maxsize=None)
+def retrieve_candidates(query: str) -> tuple:
+    return tuple(search_dense_local(query, top_k=CANDIDATES)), tuple(search_sparse(query, top_k=CANDIDATES))
+
+def search_dense_cached(query: str, top_k: int = 5) -> List[str]:
+    # ranked lists are prefixes of each other, so the top CANDIDATES cover any top_k below it
+    return list(retrieve_candidates(query)[0][:top_k])
+
+def search_hybrid_bm25(query: str, top_k: int = 5) -> List[str]:
+    # one RRF pass over the cached dense and sparse candidate lists
+    return rrf(retrieve_candidates(query), top_k)
+
+async def eval_pipeline(queries: Dict[str, Dict], qrels: Dict[str, Dict], search_fn, name: str):
     k = 5
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def run_query(q):
+        async with sem:
+            return await asyncio.to_thread(search_fn, q["text"], top_k=k)
+
+    qids = list(queries)
+    all_results = await asyncio.gather(*(run_query(queries[qid]) for qid in qids))
+
     correct, total = 0, 0
-    for qid, q in queries.items():
-        results = search_fn(q["text"], top_k=k)
+    for qid, results in zip(qids, all_results):
         gold = set(qrels[qid].keys())
         if any(doc_id in gold for doc_id in results):
             correct += 1
@@ -154,8 +340,10 @@ if __name__ == "__main__":
 
     # Step 2: Setup Qdrant collection
     setup_collection()
-    upload_corpus(corpus)
+    asyncio.run(upload_corpus(corpus))
 
     # Step 3: Evaluate
-    eval_pipeline(queries, qrels, search_dense, "Dense Only")
-    eval_pipeline(queries, qrels, search_hybrid_bm25, "Hybrid (Dense+SPLADE)")
+    encode_queries_sparse([q["text"] for q in queries.values()])
+    asyncio.run(eval_pipeline(queries, qrels, search_dense, "Dense Only (Qdrant)"))
+    asyncio.run(eval_pipeline(queries, qrels, search_dense_cached, "Dense Only"))
+    asyncio.run(eval_pipeline(queries, qrels, search_hybrid_bm25, "Hybrid (Dense+SPLADE)"))
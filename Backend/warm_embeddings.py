@@ -0,0 +1,57 @@
+# warm_embeddings.py
+"""
+Precompute Gemini query embeddings for frequent questions so the API can answer
+them without an embedding round-trip.
+
+Reads one question per line from FAQ_FILE and writes {question: embedding} to
+OUTPUT_FILE, which main.py loads at startup (WARM_EMBEDDINGS_FILE).
+"""
+
+import os
+import orjson
+from dotenv import load_dotenv
+from tenacity import retry, wait_exponential, stop_after_attempt
+import google.generativeai as genai
+
+load_dotenv()
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+if not GOOGLE_API_KEY:
+    raise SystemExit("Set GOOGLE_API_KEY in .env")
+
+# Config - change as needed
+FAQ_FILE = "faq_questions.txt"         # one question per line
+OUTPUT_FILE = "warm_embeddings.json"
+EMBEDDING_MODEL = "models/gemini-embedding-001"  # must match main.py
+EMBED_BATCH_SIZE = 100
+
+genai.configure(api_key=GOOGLE_API_KEY)
+
+
+@retry(wait=wait_exponential(multiplier=1, min=2, max=10), stop=stop_after_attempt(5))
+def create_query_embeddings(texts):
+    # same task type as main.get_dense_embedding so vectors are interchangeable
+    resp = genai.embed_content(model=EMBEDDING_MODEL, content=texts, task_type="RETRIEVAL_DOCUMENT")
+    return resp["embedding"]
+
+
+def main():
+    if not os.path.exists(FAQ_FILE):
+        raise SystemExit(f"{FAQ_FILE} not found")
+    with open(FAQ_FILE, "r", encoding="utf-8") as f:
+        # main.py strips and lowercases queries before embedding
+        questions = list(dict.fromkeys(line.strip().lower() for line in f if line.strip()))
+
+    warm = {}
+    for start in range(0, len(questions), EMBED_BATCH_SIZE):
+        batch = questions[start:start + EMBED_BATCH_SIZE]
+        warm.update(zip(batch, create_query_embeddings(batch)))
+
+    with open(OUTPUT_FILE, "wb") as f:
+        f.write(orjson.dumps(warm))
+    print(f"Saved {len(warm)} warm embeddings to {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
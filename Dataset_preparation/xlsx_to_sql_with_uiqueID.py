@@ -1,5 +1,41 @@
 import openpyxl
 import re
+from itertools import repeat
+
+# compiled once; used for every name in every staff cell
+_DR_RE = re.compile(r'(Dr\.|Dr|\?)+', re.IGNORECASE)
+_COMMA_RE = re.compile(r',\s*')
+
+# rows per multi-row INSERT statement
+INSERT_BATCH_SIZE = 500
+
+def _sql_str(value):
+    """
+    Formats a value as a SQL string literal, or NULL for None. Backslashes are
+    escaped first (MySQL treats them as escape characters by default), then
+    single quotes are doubled.
+    """
+    if value is None:
+        return 'NULL'
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+def _multi_row_insert(table, columns, rows):
+    """
+    Builds multi-row INSERT statements of up to INSERT_BATCH_SIZE rows each.
+
+    Args:
+        table (str): The target table name.
+        columns (list): Column names, in the order of the values in each row.
+        rows (list): Rows of already formatted SQL literals.
+
+    Returns:
+        A list of SQL statements as strings.
+    """
+    statements = []
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        values = ",\n".join(f"({', '.join(row)})" for row in rows[start:start + INSERT_BATCH_SIZE])
+        statements.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES\n{values};")
+    return statements
 
 def generate_sql_from_xlsx(file_path):
     """
@@ -26,6 +62,7 @@ def generate_sql_from_xlsx(file_path):
     staff_roles = ['HOD', 'Professors', 'Associate Professor', 'Assisstant Professor', 'Registrar', 'Consultants', 'Senior Registrar', 'PGRs', 'Hos']
 
     # Load the workbook and get the active sheet
+    # (not read_only: read-only sheets drop hyperlinks, which hold the doctor profile URLs)
     try:
         workbook = openpyxl.load_workbook(file_path, data_only=True)
         sheet = workbook.active
@@ -34,7 +71,7 @@ def generate_sql_from_xlsx(file_path):
         return []
 
     # Map column names to their indices
-    header = [cell.value for cell in sheet[1]]
+    header = list(next(sheet.iter_rows(max_row=1, values_only=True)))
     role_indices = {role: header.index(role) + 1 for role in staff_roles if role in header}
     dept_index = header.index('Department') + 1 if 'Department' in header else -1
     notes_index = header.index('Notes') + 1 if 'Notes' in header else -1
@@ -46,25 +83,37 @@ def generate_sql_from_xlsx(file_path):
         print("Error: 'Department' column not found.")
         return []
 
+    def column_values(col_index):
+        # every value below the header in one column; blanks when the column is missing
+        if col_index == -1:
+            return (None,) * (sheet.max_row - 1)
+        return next(sheet.iter_cols(min_col=col_index, max_col=col_index, min_row=2, values_only=True))
+
+    # pull only the columns that are used, each in a single pass, then walk them row by row
+    role_columns = [column_values(col_index) for col_index in role_indices.values()]
+    rows = zip(
+        column_values(dept_index),
+        column_values(notes_index),
+        column_values(opd_index),
+        column_values(emergency_index),
+        column_values(diagnostic_index),
+        zip(*role_columns) if role_columns else repeat(()),
+    )
+
     current_department_name = None
 
-    for row_idx, row in enumerate(sheet.iter_rows(min_row=2)):
+    # cell objects are only looked up for hyperlinks
+    for row_idx, (department_cell_value, notes, opd_days_value, emergency_days_value, diagnostic_facilities_value, staff_strings) in enumerate(rows):
         # Determine the current department
-        department_cell_value = row[dept_index - 1].value
         if department_cell_value and department_cell_value != 'nan':
             current_department_name = department_cell_value.strip()
 
         if current_department_name:
             # Handle department notes
             if current_department_name not in departments_data:
-                notes = row[notes_index - 1].value if notes_index != -1 and row[notes_index - 1].value else ''
-                departments_data[current_department_name] = notes.strip()
+                departments_data[current_department_name] = (notes or '').strip()
 
             # Handle facilities
-            opd_days_value = row[opd_index - 1].value if opd_index != -1 else ''
-            emergency_days_value = row[emergency_index - 1].value if emergency_index != -1 else ''
-            diagnostic_facilities_value = row[diagnostic_index - 1].value if diagnostic_index != -1 else ''
-
             if any([opd_days_value, emergency_days_value, diagnostic_facilities_value]):
                 if current_department_name not in facilities_data:
                     facilities_data[current_department_name] = {'opd': [], 'emergency': [], 'diagnostic': []}
@@ -77,21 +126,19 @@ def generate_sql_from_xlsx(file_path):
                     facilities_data[current_department_name]['diagnostic'].append(diagnostic_facilities_value)
 
             # Process staff
-            for role_name, col_index in role_indices.items():
-                cell = row[col_index - 1]
-                staff_string = cell.value
-                
+            for (role_name, col_index), staff_string in zip(role_indices.items(), staff_strings):
                 if staff_string and staff_string != 'nan':
-                    staff_list = [name.strip() for name in str(staff_string).split(',')]
+                    # Check for a hyperlink in the cell (row_idx 0 is sheet row 2)
+                    hyperlink = sheet.cell(row=row_idx + 2, column=col_index).hyperlink
+                    staff_list = [name.strip() for name in _COMMA_RE.split(str(staff_string))]
                     
                     for name in staff_list:
-                        clean_name = re.sub(r'(Dr\.|Dr|\?)+', '', name, flags=re.I).strip()
+                        clean_name = _DR_RE.sub('', name).strip()
                         
                         if clean_name:
                             profile_url = None
-                            # Check for a hyperlink in the cell
-                            if cell.hyperlink and cell.hyperlink.target:
-                                profile_url = cell.hyperlink.target
+                            if hyperlink and hyperlink.target:
+                                profile_url = hyperlink.target
                             
                             # Create a unique key for the doctor based on name, role, and department
                             unique_doctor_key = f"{clean_name}|{role_name}|{current_department_name}|{row_idx}"
@@ -110,49 +157,55 @@ def generate_sql_from_xlsx(file_path):
                                 'role': role_name
                             })
 
+    # Assign primary keys here so the linking tables can use literal ids instead of
+    # per-row SELECT subqueries (assumes the script is loaded into empty tables)
+    role_ids = {role: i + 1 for i, role in enumerate(staff_roles)}
+    department_ids = {name: i + 1 for i, name in enumerate(departments_data)}
+    doctor_ids = {key: i + 1 for i, key in enumerate(doctors_data)}
+
     # Generate INSERT statements for `staff_roles`
-    for role in staff_roles:
-        sql_statements.append(f"INSERT INTO staff_roles (role_name) VALUES ('{role}');")
-        
+    sql_statements.extend(_multi_row_insert(
+        'staff_roles', ['role_id', 'role_name'],
+        [[str(role_ids[role]), _sql_str(role)] for role in staff_roles]
+    ))
+
     # Generate INSERT statements for `departments`
-    for name, notes in departments_data.items():
-        sql_statements.append(f"INSERT INTO departments (name, notes) VALUES ('{name}', '{notes}');")
-    
+    sql_statements.extend(_multi_row_insert(
+        'departments', ['department_id', 'name', 'notes'],
+        [[str(department_ids[name]), _sql_str(name), _sql_str(notes)] for name, notes in departments_data.items()]
+    ))
+
     # Generate INSERT statements for `doctors`
-    for key, data in doctors_data.items():
-        url_part = f", '{data['url']}'" if data['url'] else ", NULL"
-        # We need to make the name unique for insertion. Let's append the unique_key.
-        # This will make sure each doctor gets their own record
-        unique_name_for_insertion = f"{data['name']} ({key.split('|')[-1]})"
-        sql_statements.append(f"INSERT INTO doctors (name, profile_url) VALUES ('{unique_name_for_insertion}'{url_part});")
+    # We need to make the name unique for insertion, so append the row index from the unique_key.
+    # This will make sure each doctor gets their own record
+    sql_statements.extend(_multi_row_insert(
+        'doctors', ['doctor_id', 'name', 'profile_url'],
+        [
+            [str(doctor_ids[key]), _sql_str(f"{data['name']} ({key.split('|')[-1]})"), _sql_str(data['url'])]
+            for key, data in doctors_data.items()
+        ]
+    ))
 
     # Generate INSERT statements for `department_facilities`
+    facility_rows = []
     for department_name, data in facilities_data.items():
         opd_str = ', '.join(data['opd']).strip(', ')
         emergency_str = ', '.join(data['emergency']).strip(', ')
         diagnostic_str = ', '.join(data['diagnostic']).strip(', ')
-        
-        sql_statements.append(f"""
-        INSERT INTO department_facilities (department_id, opd_days, emergency_days, diagnostic_facilities)
-        VALUES (
-            (SELECT department_id FROM departments WHERE name = '{department_name}'),
-            '{opd_str}',
-            '{emergency_str}',
-            '{diagnostic_str}'
-        );
-        """)
-    
+        facility_rows.append([str(department_ids[department_name]), _sql_str(opd_str), _sql_str(emergency_str), _sql_str(diagnostic_str)])
+    sql_statements.extend(_multi_row_insert(
+        'department_facilities', ['department_id', 'opd_days', 'emergency_days', 'diagnostic_facilities'],
+        facility_rows
+    ))
+
     # Generate INSERT statements for `department_staff` (linking table)
-    for link in staff_links_to_insert:
-        unique_name = f"{doctors_data[link['unique_key']]['name']} ({link['unique_key'].split('|')[-1]})"
-        sql_statements.append(f"""
-        INSERT INTO department_staff (department_id, doctor_id, role_id)
-        VALUES (
-            (SELECT department_id FROM departments WHERE name = '{link['department']}'),
-            (SELECT doctor_id FROM doctors WHERE name = '{unique_name}'),
-            (SELECT role_id FROM staff_roles WHERE role_name = '{link['role']}')
-        );
-        """)
+    sql_statements.extend(_multi_row_insert(
+        'department_staff', ['department_id', 'doctor_id', 'role_id'],
+        [
+            [str(department_ids[link['department']]), str(doctor_ids[link['unique_key']]), str(role_ids[link['role']])]
+            for link in staff_links_to_insert
+        ]
+    ))
 
     return sql_statements
 
@@ -1,6 +1,10 @@
 import openpyxl
 import re
 
+# compiled once; used for every name in every staff cell
+_DR_RE = re.compile(r'(Dr\.|Dr|\?)+', re.IGNORECASE)
+_COMMA_RE = re.compile(r',\s*')
+
 def generate_text_chunks_from_xlsx(file_path):
     """
     Reads an XLSX file, parses the data, and generates semantically rich text chunks for RAG.
@@ -25,6 +29,7 @@ def generate_text_chunks_from_xlsx(file_path):
         'Services & treatments offered', 'OPD Room'
     ]
 
+    # (not read_only: read-only sheets drop hyperlinks, which hold department/staff/detail links)
     try:
         workbook = openpyxl.load_workbook(file_path, data_only=True)
         sheet = workbook.active
@@ -36,7 +41,7 @@ def generate_text_chunks_from_xlsx(file_path):
         return []
 
     # Map column names to their indices
-    header = [cell.value for cell in sheet[1]]
+    header = list(next(sheet.iter_rows(max_row=1, values_only=True)))
     col_indices = {}
     for i, col_name in enumerate(header):
         if col_name and str(col_name).strip() in (staff_roles + detail_cols + ['Department']):
@@ -49,10 +54,14 @@ def generate_text_chunks_from_xlsx(file_path):
     departments_data = {}
     current_department_name = None
 
+    def hyperlink_target(row_idx, col_idx):
+        # values_only rows carry no hyperlinks; fetch the cell only when a link is needed
+        hyperlink = sheet.cell(row=row_idx + 2, column=col_idx + 1).hyperlink
+        return hyperlink.target if hyperlink and hyperlink.target else None
+
     # Step 1: Aggregate all data by department
-    for row_idx, row in enumerate(sheet.iter_rows(min_row=2)):
-        department_cell = row[col_indices['Department']]
-        department_cell_value = department_cell.value
+    for row_idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True)):
+        department_cell_value = row[col_indices['Department']]
         
         # Check for a new department
         if department_cell_value and str(department_cell_value).strip() not in ('nan', '...', ''):
@@ -65,8 +74,9 @@ def generate_text_chunks_from_xlsx(file_path):
             }
             
             # Handle department hyperlink
-            if department_cell.hyperlink and department_cell.hyperlink.target:
-                departments_data[current_department_name]['links']['department'] = department_cell.hyperlink.target
+            department_link = hyperlink_target(row_idx, col_indices['Department'])
+            if department_link:
+                departments_data[current_department_name]['links']['department'] = department_link
         
         # Ensure we have a department to associate data with
         if not current_department_name:
@@ -75,30 +85,30 @@ def generate_text_chunks_from_xlsx(file_path):
         # Aggregate staff members and their links
         for role_name in staff_roles:
             if role_name in col_indices:
-                cell = row[col_indices[role_name]]
-                cell_value = cell.value
+                cell_value = row[col_indices[role_name]]
 
                 if cell_value and str(cell_value).strip() not in ('nan', '...', ''):
-                    staff_list = [name.strip() for name in str(cell_value).split(',')]
+                    staff_link = hyperlink_target(row_idx, col_indices[role_name])
+                    staff_list = [name.strip() for name in _COMMA_RE.split(str(cell_value))]
                     for name in staff_list:
-                        clean_name = re.sub(r'(Dr\.|Dr|\?)+', '', name, flags=re.I).strip()
+                        clean_name = _DR_RE.sub('', name).strip()
                         if clean_name:
                             departments_data[current_department_name]['staff'][role_name].add(clean_name)
                             # Add hyperlink if it exists for the cell
-                            if cell.hyperlink and cell.hyperlink.target:
+                            if staff_link:
                                 # A simplified way to store staff links
                                 if clean_name not in departments_data[current_department_name]['links']:
-                                    departments_data[current_department_name]['links'][clean_name] = cell.hyperlink.target
+                                    departments_data[current_department_name]['links'][clean_name] = staff_link
         
         # Aggregate department details
         for col_name in detail_cols:
             if col_name in col_indices:
-                cell = row[col_indices[col_name]]
-                cell_value = cell.value
+                cell_value = row[col_indices[col_name]]
                 if cell_value and str(cell_value).strip() not in ('nan', '...', ''):
                     # Handle special case for '...' entries with hyperlinks
-                    if str(cell_value).strip() == '...' and cell.hyperlink and cell.hyperlink.target:
-                        departments_data[current_department_name]['details'][col_name].add(cell.hyperlink.target)
+                    detail_link = hyperlink_target(row_idx, col_indices[col_name]) if str(cell_value).strip() == '...' else None
+                    if detail_link:
+                        departments_data[current_department_name]['details'][col_name].add(detail_link)
                     else:
                         departments_data[current_department_name]['details'][col_name].add(str(cell_value).strip())
 